@@ -1,7 +1,10 @@
 # Module for generic shotgun preprocessing steps
 
 import os,sys,re
+import io
+import gzip
 import shutil
+import pickle
 import itertools
 import sqlite3
 import distutils
@@ -13,34 +16,158 @@ from cgatcore import iotools as IOTools
 from cgatcore import experiment as E
 
 
+# compiled once at import; anchored and escaped so matching
+# short-circuits as early as possible on non-fastq entries
+FQ1_REGEX = re.compile(r'(\S+)\.(fastq\.1\.gz)$')
+FQ2_REGEX = re.compile(r'(\S+)\.(fastq\.2\.gz)$')
+
+
+class _OwningGzipFile(gzip.GzipFile):
+    '''GzipFile over an explicitly buffered raw handle. The stock
+    class never closes a caller-supplied fileobj, which would leave the
+    gzip trailer sitting in the raw handle's write buffer until garbage
+    collection; this variant owns the raw handle and closes it (and so
+    flushes it) when the stream is closed.'''
+
+    def __init__(self, raw, mode):
+        super().__init__(fileobj=raw, mode=mode)
+        self._raw = raw
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            if not self._raw.closed:
+                self._raw.close()
+
+
 class utility():
     # Check that the input files correspond
     def check_input(datadir='.'):
-        
-        fq1_regex = re.compile('(\S+).(fastq.1.gz)')
-        mask1 = list(map(lambda x: bool(fq1_regex.match(x)),
-                         os.listdir(datadir)))
-        fastq1s = [os.path.join(datadir, i) \
-                   for i in itertools.compress(os.listdir(datadir),
-                                               mask1)]
-
-        if sum(mask1):
-            fq2_regex = re.compile('(\S+).(fastq.2.gz)')
-            mask2 = list(map(lambda x: bool(fq2_regex.match(x)),
-                             os.listdir(datadir)))
-            fastq2s = [os.path.join(datadir, i) \
-                       for i in itertools.compress(os.listdir(datadir), mask2)]
-            if sum(mask2):
-                assert sum(mask1) == sum(mask2), 'Not all input files have pairs'
-                fq1_stubs = [fq1_regex.match(x).group(1) for x in fastq1s]
-                fq2_stubs = [fq2_regex.match(x).group(1) for x in fastq2s]
-                assert sorted(fq1_stubs) == sorted(fq2_stubs), \
-                    "First and second read pair files do not correspond"        
-        else:
+
+        fq1_regex = FQ1_REGEX
+        fq2_regex = FQ2_REGEX
+
+        # scan the input directory once; pair correspondence is then
+        # checked with set membership rather than repeated listdirs.
+        # DirEntry caches its stat, so is_file() costs no extra syscall
+        # and skips stray subdirectories up front
+        with os.scandir(datadir) as entries:
+            names = [x.name for x in entries if x.is_file()]
+
+        fastq1_names = [x for x in names if fq1_regex.fullmatch(x)]
+        fastq2_names = [x for x in names if fq2_regex.fullmatch(x)]
+
+        if not fastq1_names:
             raise ValueError("No input files detected in run directory."
                              " Check the file suffixes follow the notation"
                              " fastq.1.gz and fastq.2.gz.")
 
+        if fastq2_names:
+            assert len(fastq1_names) == len(fastq2_names), \
+                'Not all input files have pairs'
+            fq1_stubs = {fq1_regex.fullmatch(x).group(1) for x in fastq1_names}
+            fq2_stubs = {fq2_regex.fullmatch(x).group(1) for x in fastq2_names}
+            assert fq1_stubs == fq2_stubs, \
+                "First and second read pair files do not correspond"
+
+        return [os.path.join(datadir, x) for x in fastq1_names]
+
+    # buffer size for streaming compressed files; the stdlib defaults
+    # cause frequent small reads on multi-GB FASTQ files
+    BUFFER_SIZE = 1 << 17
+
+    def open_file(filename, mode='r'):
+        '''Open a (possibly gzipped) file, preferring xopen where it is
+        installed. xopen uses the ISA-L accelerated gzip codec and
+        pigz for writing, which is several-fold faster than the stdlib
+        gzip module used by IOTools.open_file.'''
+
+        # match IOTools behaviour, which opens in text mode by default
+        if mode in ('r', 'w', 'a'):
+            mode += 't'
+
+        try:
+            from xopen import xopen
+        except ImportError:
+            if not filename.endswith('.gz'):
+                return IOTools.open_file(filename, mode)
+            # stdlib fallback, with a 128 KiB buffer under the
+            # decompressor instead of the io default
+            raw = open(filename, mode[0] + 'b',
+                       buffering=utility.BUFFER_SIZE)
+            fh = _OwningGzipFile(raw, mode[0])
+            if 't' in mode:
+                fh = io.TextIOWrapper(fh)
+            return fh
+
+        return xopen(filename, mode)
+
+    def gzip_empty(filename):
+        '''Test whether a gzipped file contains any data without
+        decompressing it. An empty gzip member is ~20-28 bytes, and
+        anything beyond 1 KiB of compressed data cannot be empty; only
+        the small in-between cases are actually opened, which also
+        keeps the check correct for multi-member gzip files.'''
+
+        size = os.stat(filename).st_size
+        if size <= 28:
+            return True
+        if size > 1024:
+            return False
+
+        with gzip.open(filename, 'rb') as inf:
+            return not inf.read(1)
+
+    def compress_command(PARAMS):
+        '''Return the command used to compress intermediate outputs.
+        Uses the configured compress_cmd where set, otherwise pigz
+        with pigz_threads where it is on PATH, falling back to
+        single-threaded gzip.
+
+        Any drop-in gzip replacement works here, e.g. "bgzip -@ 4":
+        BGZF output is plain gzip to every consumer, but block-indexed,
+        so downstream readers that understand it can decompress in
+        parallel or seek.'''
+
+        compress_cmd = PARAMS.get('compress_cmd')
+        if compress_cmd:
+            return compress_cmd
+        if shutil.which('pigz'):
+            return 'pigz -p %s' % PARAMS.get('pigz_threads', 4)
+        return 'gzip'
+
+    def count_fastq_reads(filename):
+        '''Count the reads in a (gzipped) FASTQ file in-process.
+        bytes.count delegates newline counting to a vectorised memchr
+        loop, so this avoids forking a shell pipeline per file.'''
+
+        nlines = 0
+        with utility.open_file(filename, 'rb') as inf:
+            block = inf.read(1 << 20)
+            while block:
+                nlines += block.count(b'\n')
+                block = inf.read(1 << 20)
+
+        return nlines // 4
+
+    def cached_check_input(datadir='.', cache='.check_input.cache.pkl'):
+        '''check_input, memoised to a pickle and invalidated when the
+        input directory mtime changes. Avoids re-walking large input
+        directories on every pipeline invocation.'''
+
+        mtime = os.stat(datadir).st_mtime_ns
+
+        if os.path.exists(cache):
+            with open(cache, 'rb') as inf:
+                cached_mtime, fastq1s = pickle.load(inf)
+            if cached_mtime == mtime:
+                return fastq1s
+
+        fastq1s = utility.check_input(datadir)
+        with open(cache, 'wb') as outf:
+            pickle.dump((mtime, fastq1s), outf)
+
         return fastq1s
 
     def symlnk(inf, outf):
@@ -92,72 +219,120 @@ class matchReference(object):
             self.fastq3 = fastq3
             
 class cdhit(matchReference):
-        
-    def buildStatement(self):
-        '''Filter exact duplicates, if specified in config file'''
-        
-        fastq1 = self.fastq1
-        fastq2 = self.fastq2
+
+    def _dedupStatement(self, fastqs, outfiles):
+        '''Build the cd-hit-dup statement for one or two fastq files.
+        The PE and SE commands differ only in the second input/output
+        arguments, so both branches share this builder.'''
+
         sample_out = P.snip(self.outfile, self.fq1_suffix)
-        
-        outfile1 = P.snip(self.outfile, '.gz')
         logfile = sample_out + '.log'
         cluster_file = sample_out + '*.clstr'
-        
+
         cdhit_options = self.PARAMS['cdhit_options']
-        to_filter = self.PARAMS['cdhit_dedup']
-        
+        compress_cmd = utility.compress_command(self.PARAMS)
+        pigz_threads = self.PARAMS.get('pigz_threads', 4)
+
+        in_args = ' '.join(
+            "%s <(pigz -dc -p %s %s)" % (flag, pigz_threads, fastq)
+            for flag, fastq in zip(('-i', '-i2'), fastqs))
+
+        if self.PARAMS.get('cdhit_stream_output', 0):
+            # cd-hit-dup writes into named pipes drained by the
+            # compressor, so neither the input nor the output ever
+            # touches disk uncompressed. FIFOs rather than process
+            # substitution for the outputs, as cd-hit-dup derives
+            # its .clstr path from the -o argument.
+            fifos = [sample_out + '.fifo.%i' % n
+                     for n in range(1, len(outfiles) + 1)]
+            fifo_args = ' '.join(fifos)
+            # each drain is backgrounded inside its own group so that
+            # it does not drag the preceding and-list into the
+            # background with it, and its pid is captured so that each
+            # drain can be waited on in its own wait call: a multi-pid
+            # wait only reports the status of the last pid, which would
+            # let a failed mate-1 compressor pass unnoticed
+            drains = ' '.join(
+                "{ %s -c < %s > %s & } && drain%i=$! &&"
+                % (compress_cmd, fifo, outfile, n)
+                for n, (fifo, outfile)
+                in enumerate(zip(fifos, outfiles), 1))
+            drain_waits = ' && '.join(
+                'wait $drain%i' % n for n in range(1, len(outfiles) + 1))
+            out_args = ' '.join(
+                '%s %s' % (flag, fifo)
+                for flag, fifo in zip(('-o', '-o2'), fifos))
+
+            statement = ("rm -f %(fifo_args)s &&"
+                         " mkfifo %(fifo_args)s &&"
+                         " %(drains)s"
+                         " cd-hit-dup"
+                         "  %(in_args)s"
+                         "  %(out_args)s"
+                         "  %(cdhit_options)s"
+                         " &> %(logfile)s &&"
+                         " %(drain_waits)s &&"
+                         " %(compress_cmd)s %(logfile)s &&"
+                         " rm -f %(fifo_args)s %(cluster_file)s" % locals())
+
+        else:
+            # some cd-hit-dup builds refuse to write into a pipe;
+            # stage plaintext outputs and compress them afterwards
+            tmpfs = [sample_out + '.tmp.%i' % n
+                     for n in range(1, len(outfiles) + 1)]
+            tmp_args = ' '.join(tmpfs)
+            out_args = ' '.join(
+                '%s %s' % (flag, tmpf)
+                for flag, tmpf in zip(('-o', '-o2'), tmpfs))
+            compressions = ' '.join(
+                "%s -c %s > %s &&" % (compress_cmd, tmpf, outfile)
+                for tmpf, outfile in zip(tmpfs, outfiles))
+
+            statement = ("cd-hit-dup"
+                         "  %(in_args)s"
+                         "  %(out_args)s"
+                         "  %(cdhit_options)s"
+                         " &> %(logfile)s &&"
+                         " %(compressions)s"
+                         " %(compress_cmd)s %(logfile)s &&"
+                         " rm -f %(tmp_args)s %(cluster_file)s" % locals())
+
+        return statement
+
+    def buildStatement(self):
+        '''Filter exact duplicates, if specified in config file'''
+
         if self.fastq2:
             outfile2 = re.sub(self.fq1_suffix, self.fq2_suffix, self.outfile)
-            outfile2 = P.snip(outfile2, '.gz')
-            
-            if to_filter:
-                tmpf1 = P.get_temp_filename('.')
-                tmpf2 = P.get_temp_filename('.')
-                statement = ("zcat %(fastq1)s > %(tmpf1)s &&"
-                             " zcat %(fastq2)s > %(tmpf2)s &&"
-                             " cd-hit-dup"
-                             "  -i %(tmpf1)s"
-                             "  -i2 %(tmpf2)s"
-                             "  -o %(outfile1)s"
-                             "  -o2 %(outfile2)s"
-                             "  %(cdhit_options)s"
-                             " &> %(logfile)s &&"
-                             " gzip %(outfile1)s &&"
-                             " gzip %(outfile2)s &&"
-                             " gzip %(logfile)s &&"
-                             " rm -f %(tmpf1)s &&"
-                             " rm -f %(tmpf2)s &&"
-                             " rm -f %(cluster_file)s" % locals())
-            else:
-                E.warn('Deduplication step is being skipped for: %s' % fastq1)
-                utility.symlnk(fastq1, self.outfile)
-                utility.symlnk(fastq2, outfile2 + '.gz')
+
+            if not self.PARAMS['cdhit_dedup']:
+                E.warn('Deduplication step is being skipped for: %s'
+                       % self.fastq1)
+                utility.symlnk(self.fastq1, self.outfile)
+                utility.symlnk(self.fastq2, outfile2)
+                return None
+
+            return self._dedupStatement([self.fastq1, self.fastq2],
+                                        [self.outfile, outfile2])
 
         else:
-            if to_filter:
-                tmpf1 = P.get_temp_filename('.')
-                statement = ("zcat %(fastq1)s > %(tmpf1)s"
-                             " cd-hit-dup"
-                             "  -i %(tmpf1)s"
-                             "  -o %(outfile1)s"
-                             "  %(cdhit_options)s"
-                             " &> %(logfile)s &&"
-                             " gzip %(outfile1)s &&"
-                             " gzip %(logfile)s &&"
-                             " rm -f %(tmpf1)s &&"
-                             " rm -f %(cluster_file)s" % locals())
+            if not self.PARAMS['cdhit_dedup']:
+                E.warn('Deduplication step is being skipped for: %s'
+                       % self.fastq1)
+                utility.symlnk(self.fastq1, self.outfile)
+                return None
 
-            else:
-                E.warn('Deduplication step is being skipped for: %s' % fastq1)
-                utility.symlnk(fastq1, outfile)     
-        
-        return statement
+            return self._dedupStatement([self.fastq1], [self.outfile])
 
     def run(self):
             
         statement = self.buildStatement()
 
+        # nothing to run when deduplication is skipped and the outputs
+        # were symlinked in place
+        if statement is None:
+            return
+
         P.run(statement,
               job_threads=self.PARAMS['cdhit_job_threads'], 
               job_memory=self.PARAMS['cdhit_job_memory'],
@@ -174,7 +349,11 @@ class trimmomatic(matchReference):
         sample_out = P.snip(self.outfile, self.fq1_suffix)
         logfile = sample_out + '.trim.log'
         logfile2 = sample_out + '.log'
-        
+
+        # trimmomatic reports surviving read numbers in its summary output,
+        # so the read count side-car comes for free from the log
+        nreads_file = self.outfile + '.nreads'
+
         trimmomatic_jar_path = self.PARAMS["trimmomatic_jar_path"]
         trimmomatic_n_threads = self.PARAMS["trimmomatic_n_threads"]
         # >0.32 determines phred format automatically, here for legacy
@@ -189,6 +368,25 @@ class trimmomatic(matchReference):
         trimmomatic_quality_leading = self.PARAMS["trimmomatic_quality_leading"]
         trimmomatic_quality_trailing = self.PARAMS["trimmomatic_quality_trailing"]
         trimmomatic_minlen = self.PARAMS["trimmomatic_minlen"]
+        compress_cmd = utility.compress_command(self.PARAMS)
+
+        # the flags and trimming steps are the same for both branches;
+        # build them once so that a missing config key fails here rather
+        # than deep inside one of the statement strings
+        trim_flags = ("-threads %(trimmomatic_n_threads)s"
+                      " %(phred_format)s"
+                      " -trimlog %(logfile)s" % locals())
+
+        trim_steps = ("ILLUMINACLIP:"
+                      "%(trimmomatic_adapters)s:"
+                      "%(trimmomatic_seed_mismatches)s:"
+                      "%(trimmomatic_score_palendromic)s:"
+                      "%(trimmomatic_score_simple)s:"
+                      "%(trimmomatic_min_adapter_len)s:"
+                      "%(trimmomatic_keep_both_reads)s"
+                      " LEADING:%(trimmomatic_quality_leading)s"
+                      " TRAILING:%(trimmomatic_quality_trailing)s"
+                      " MINLEN:%(trimmomatic_minlen)s" % locals())
 
         if self.fastq2:
             outfile2 = re.sub(self.fq1_suffix, self.fq2_suffix, self.outfile)
@@ -197,51 +395,32 @@ class trimmomatic(matchReference):
             outf_singletons = sample_out + self.fq3_suffix
             
             statement = ("java -Xmx5g -jar %(trimmomatic_jar_path)s PE"
-                         " -threads %(trimmomatic_n_threads)s"
-                         " %(phred_format)s"
-                         " -trimlog %(logfile)s"
+                         " %(trim_flags)s"
                          " %(fastq1)s" # input read 1
                          " %(fastq2)s" # input read 2
                          " %(outfile1)s" # output read 1
                          " %(outf1_singletons)s" # output unpaired read 1
                          " %(outfile2)s" # output read 2
                          " %(outf2_singletons)s" # output unpaired read 2
-                         " ILLUMINACLIP:"
-                         "%(trimmomatic_adapters)s:"
-                         "%(trimmomatic_seed_mismatches)s:"
-                         "%(trimmomatic_score_palendromic)s:"
-                         "%(trimmomatic_score_simple)s:"
-                         "%(trimmomatic_min_adapter_len)s:"
-                         "%(trimmomatic_keep_both_reads)s"
-                         " LEADING:%(trimmomatic_quality_leading)s"
-                         " TRAILING:%(trimmomatic_quality_trailing)s"
-                         " MINLEN:%(trimmomatic_minlen)s"
+                         " %(trim_steps)s"
                          " &> %(logfile2)s &&"
-                         " gzip -f %(logfile)s &&"
-                         " cat %(outf1_singletons)s %(outf2_singletons)s "
-                         "  > %(outf_singletons)s &&"
-                         " rm -f %(outf1_singletons)s && rm -f %(outf2_singletons)s" % locals())
+                         " awk '/^Input Read Pairs/ {print $7}'"
+                         "  %(logfile2)s > %(nreads_file)s &&"
+                         " %(compress_cmd)s -f %(logfile)s &&"
+                         " cat %(outf2_singletons)s >> %(outf1_singletons)s &&"
+                         " mv %(outf1_singletons)s %(outf_singletons)s" % locals())
 
         else:
-            statement = ("java -Xmx5g -jar %(trimmomatic_jar_path)s PE"
-                         " -threads %(trimmomatic_n_threads)s"
-                         " -phred%(phred_format)s"
-                         " -trimlog %(logfile)s"
+            statement = ("java -Xmx5g -jar %(trimmomatic_jar_path)s SE"
+                         " %(trim_flags)s"
                          " %(fastq1)s" # input read 1
                          " %(outfile1)s" # output read 1
-                         " ILLUMINACLIP:"
-                         "%(trimmomatic_adapters)s:"
-                         "%(trimmomatic_seed_mismatches)s:"
-                         "%(trimmomatic_score_palendromic)s:"
-                         "%(trimmomatic_score_simple)s"
-                         "%(trimmomatic_min_adapter_len)s:"
-                         "%(trimmomatic_keep_both_reads)s"
-                         " LEADING:%(trimmomatic_quality_leading)s"
-                         " TRAILING:%(trimmomatic_quality_trailing)s"
-                         " MINLEN:%(trimmomatic_minlen)s"
+                         " %(trim_steps)s"
                          " &> %(logfile2)s &&"
-                         " gzip -f %(logfile)s" % locals())
-                
+                         " awk '/^Input Reads/ {print $5}'"
+                         "  %(logfile2)s > %(nreads_file)s &&"
+                         " %(compress_cmd)s -f %(logfile)s" % locals())
+
         return statement
 
     def run(self):
@@ -254,6 +433,67 @@ class trimmomatic(matchReference):
               job_options = self.PARAMS.get('trimmomatic_job_options', ''))
 
 
+class fastp(matchReference):
+    """
+    Fused deduplication, adapter removal and quality trimming using
+    fastp. One multi-threaded pass over the input replaces the
+    separate cd-hit-dup and trimmomatic stages, halving the
+    decompress/recompress cycles at the head of the pipeline.
+    """
+
+    def buildStatement(self):
+        fastq1 = self.fastq1
+        fastq2 = self.fastq2
+        outfile1 = self.outfile
+        sample_out = P.snip(self.outfile, self.fq1_suffix)
+        outfile2 = sample_out + self.fq2_suffix
+        outfile3 = sample_out + self.fq3_suffix
+        logfile = sample_out + '.log'
+
+        fastp_options = self.PARAMS.get('fastp_options', '')
+        job_threads = self.PARAMS['fastp_job_threads']
+
+        if self.fastq2:
+            # reads orphaned by filtering either mate are collected in
+            # the singleton file, mirroring the trimmomatic output
+            statement = ("fastp"
+                         "  --in1 %(fastq1)s"
+                         "  --in2 %(fastq2)s"
+                         "  --out1 %(outfile1)s"
+                         "  --out2 %(outfile2)s"
+                         "  --unpaired1 %(outfile3)s"
+                         "  --dedup"
+                         "  --detect_adapter_for_pe"
+                         "  --compression 1"
+                         "  --thread %(job_threads)s"
+                         "  --json %(sample_out)s.fastp.json"
+                         "  --html %(sample_out)s.fastp.html"
+                         "  %(fastp_options)s"
+                         "  &> %(logfile)s" % locals())
+        else:
+            statement = ("fastp"
+                         "  --in1 %(fastq1)s"
+                         "  --out1 %(outfile1)s"
+                         "  --dedup"
+                         "  --compression 1"
+                         "  --thread %(job_threads)s"
+                         "  --json %(sample_out)s.fastp.json"
+                         "  --html %(sample_out)s.fastp.html"
+                         "  %(fastp_options)s"
+                         "  &> %(logfile)s" % locals())
+
+        return statement
+
+    def run(self):
+
+        statement = self.buildStatement()
+
+        P.run(statement,
+              job_threads=self.PARAMS['fastp_job_threads'],
+              job_memory=self.PARAMS['fastp_job_memory'],
+              job_options=self.PARAMS.get('fastp_job_options', ''))
+
+
 def removeContaminants(in_fastq, out_fastq, method, **PARAMS):
     """
     Remove sequences of non-microbiome origin
@@ -296,8 +536,19 @@ class runSortMeRNA(matchReference):
         references = self.PARAMS.get("sortmerna_reference")
         references = ' --ref '.join(references.split(','))
         # All listed references must be pre-indexed in this location
-        index_dir = self.PARAMS.get("sortmerna_index") # Check this isn't automatically passed. 
-        
+        index_dir = self.PARAMS.get("sortmerna_index") # Check this isn't automatically passed.
+
+        # Optionally stage the index into shared memory on the execution
+        # node; samples scheduled to the same node then skip re-reading
+        # several GB of index from the filesystem.
+        shm_prefix = ''
+        if self.PARAMS.get('sortmerna_shm_index', False):
+            shm_dir = '/dev/shm/$USER.sortmerna_idx'
+            shm_prefix = ("mkdir -p %(shm_dir)s &&"
+                          " rsync -a --ignore-existing"
+                          "  %(index_dir)s/ %(shm_dir)s/ && " % locals())
+            index_dir = shm_dir
+
         tmpf = P.get_temp_dir('.')
         tmpf_kvdb = os.path.join(tmpf, 'kvdb')
         tmpf_readb = os.path.join(tmpf, 'readb')
@@ -348,7 +599,7 @@ class runSortMeRNA(matchReference):
                          " --zip-out"
                          " %(sortmerna_options)s" % locals())
         
-        if not self.sortmerna_skip_singletons and IOTools.open_file(self.fastq3).read(1):
+        if not self.sortmerna_skip_singletons and not utility.gzip_empty(self.fastq3):
             in_fastq3 = self.fastq3
             statement_2 = ("sortmerna"
                            # " --index 0" # skip indexing, assume in idx-dir
@@ -369,10 +620,10 @@ class runSortMeRNA(matchReference):
                                      statement_2,
                                      "rm -rf %(tmpf)s" % locals()])
         else:
-            statement = " && ".join([statement, 
+            statement = " && ".join([statement,
                                      "rm -rf %(tmpf)s" % locals()])
 
-        return statement
+        return shm_prefix + statement
     
     def run(self):
 
@@ -412,7 +663,7 @@ class runSortMeRNA(matchReference):
                       outf_prefix + '_rRNAremoved'+self.fq2_suffix)
 
         # rename fastq3 files
-        if not self.sortmerna_skip_singletons and IOTools.open_file(self.fastq3).read(1):            
+        if not self.sortmerna_skip_singletons and not utility.gzip_empty(self.fastq3):            
             os.rename(f3_aligned,
                       outf_prefix + '_rRNA' + self.fq3_suffix)
 
@@ -509,18 +760,48 @@ class bmtagger(matchReference):
 
         fastq1 = self.fastq1
         outfile = self.outfile
+        pigz_threads = self.PARAMS.get('pigz_threads', 4)
+
+        # bmtagger needs uncompressed input; decompress each fastq once
+        # to a shared temp file rather than once per host index
+        stage_statements = []
+        self.staged_tmpfiles = []
+
+        # the index screens run concurrently, so each writes its own
+        # hit list; run() unions them into the to_remove files once the
+        # whole batch has finished
+        self.host_hits = []
+
         if self.fastq2:
             fastq2 = self.fastq2
             fastq3 = self.fastq3
-            
-            to_remove_paired =  P.get_temp_filename('.')            
+
+            to_remove_paired =  P.get_temp_filename('.')
             to_remove_singletons = P.get_temp_filename('.')
             to_remove_tmp = [to_remove_paired, to_remove_singletons]
- 
+
+            tmpf1 = P.get_temp_filename('.')
+            tmpf2 = P.get_temp_filename('.')
+            tmpf3 = P.get_temp_filename('.')
+            self.staged_tmpfiles = [tmpf1, tmpf2, tmpf3]
+
+            have_singletons = (os.path.exists(self.fastq3) and
+                               not utility.gzip_empty(self.fastq3))
+
+            stage_statements = [
+                "pigz -dc -p %(pigz_threads)s %(fastq1)s"
+                " > %(tmpf1)s" % locals(),
+                "pigz -dc -p %(pigz_threads)s %(fastq2)s"
+                " > %(tmpf2)s" % locals()]
+            if have_singletons:
+                stage_statements.append(
+                    "pigz -dc -p %(pigz_threads)s %(fastq3)s"
+                    " > %(tmpf3)s" % locals())
+
             # In some cases, it may be desirable to screen against multiple hosts.
             indexes = zip(self.PARAMS['bmtagger_bitmask'].split(','),
                           self.PARAMS['bmtagger_srprism'].split(','))
-            
+
             statements=[]
             for n, indexes in enumerate(indexes, 1):
                 n = str(n)
@@ -529,17 +810,11 @@ class bmtagger(matchReference):
                 # Screen the paired reads, then singletons
                 tmpdir1 = P.get_temp_dir('.')
                 tmpdir2 = P.get_temp_dir('.')
-            
-                tmpf1 = P.get_temp_filename('.')
-                tmpf2 = P.get_temp_filename('.')
-                tmpf3 = P.get_temp_filename('.')
-    
+
                 # bmtagger truncates fasta headers...  sed 's/[[:space:]]\+/__/g'
                 # It won't accept... sed 's|[[:space:]].*$|/1|'
                 # It also fails if fastq1 header differs from fastq2
-                statement1 = ("zcat %(fastq1)s > %(tmpf1)s &&"
-                              " zcat %(fastq2)s > %(tmpf2)s &&"
-                              " bmtagger.sh"
+                statement1 = ("bmtagger.sh"
                               "  -b %(bitmask)s"
                               "  -x %(srprism)s"
                               "  -T %(tmpdir1)s"
@@ -547,30 +822,27 @@ class bmtagger(matchReference):
                               "  -1 %(tmpf1)s"
                               "  -2 %(tmpf2)s"
                               "  -o %(outf_host_stub)s_paired%(n)s"
-                              "  &> %(outfile)s.log &&"
-                              " cat %(outf_host_stub)s_paired%(n)s"
-                              "  >> %(to_remove_paired)s &&"
-                              " rm -rf %(tmpdir1)s %(tmpf1)s %(tmpf2)s"
-                              "  %(outf_host_stub)s_paired%(n)s" % locals())
+                              "  &> %(outfile)s.log%(n)s &&"
+                              " rm -rf %(tmpdir1)s" % locals())
+                self.host_hits.append(
+                    (outf_host_stub + '_paired' + n, to_remove_paired))
 
                 # Screen the singletons
-                if os.path.exists(self.fastq3) and IOTools.open_file(self.fastq3).read(1):
-                    statement2 = ("zcat %(fastq3)s > %(tmpf3)s &&"
-                                  " bmtagger.sh"
+                if have_singletons:
+                    statement2 = ("bmtagger.sh"
                                   "  -b %(bitmask)s"
                                   "  -x %(srprism)s"
                                   "  -T %(tmpdir2)s"
                                   "  -q1" # Input is fastq
                                   "  -1 %(tmpf3)s"
                                   "  -o %(outf_host_stub)s_singletons%(n)s"
-                                  " &>> %(outfile)s.log &&"
-                                  " cat %(outf_host_stub)s_singletons%(n)s"
-                                  "  >> %(to_remove_singletons)s &&"
-                                  " rm -rf %(tmpdir2)s %(tmpf3)s"
-                                  "  %(outf_host_stub)s_singletons%(n)s" % locals())
+                                  " &>> %(outfile)s.log%(n)s &&"
+                                  " rm -rf %(tmpdir2)s" % locals())
+                    self.host_hits.append(
+                        (outf_host_stub + '_singletons' + n,
+                         to_remove_singletons))
                 else:
-                    statement2 = ("touch  %(to_remove_singletons)s &&"
-                                  " rm -rf %(tmpdir2)s %(tmpf3)s" % locals())
+                    statement2 = "rm -rf %(tmpdir2)s" % locals()
 
                 statement = " && ".join([statement1, statement2])
                 statements.append(statement)
@@ -580,38 +852,65 @@ class bmtagger(matchReference):
                           self.PARAMS['bmtagger_srprism'].split(','))
             to_remove = P.get_temp_filename('.')
             to_remove_tmp = [to_remove]
-            
+
+            tmpf = P.get_temp_filename('.')
+            self.staged_tmpfiles = [tmpf]
+
+            stage_statements = [
+                "pigz -dc -p %(pigz_threads)s %(fastq1)s"
+                " > %(tmpf)s" % locals()]
+
             statements = []
             for n, indexes in enumerate(indexes, 1):
                 n = str(n)
                 bitmask, srprism = indexes
                 # Screen the singletons
                 tmpdir1 = P.get_temp_dir('.')
-                tmpf = P.get_temp_filename('.')
-                
-                statement = ("zcat %(fastq1)s > %(tmpf)s &&"
-                             " bmtagger.sh"
+
+                statement = ("bmtagger.sh"
                              "  -b %(bitmask)s"
                              "  -x %(srprism)s"
                              "  -T %(tmpdir1)s"
                              "  -q1" # Input is fastq
                              "  -1 %(tmpf)s"
                              "  -o %(outf_host_stub)s_%(n)s"
-                             "  &>> %(outfile)s.log &&"
-                             " cat %(outf_host_stub)s_%(n)s >> %(to_remove)s"
-                             " rm -rf %(tmpdir1)s %(tmpf)s %(outf_host_stub)s_%(n)s" % locals())
+                             "  &> %(outfile)s.log%(n)s &&"
+                             " rm -rf %(tmpdir1)s" % locals())
                 statements.append(statement)
-                
+                self.host_hits.append((outf_host_stub + '_' + n, to_remove))
+
+        self.stage_statements = stage_statements
+
         return statements, to_remove_tmp
 
-    
+
     def run(self, statements):
-        
-        for statement in statements:
-            P.run(statement, 
-                  job_threads=self.PARAMS['bmtagger_job_threads'], 
-                  job_memory=self.PARAMS['bmtagger_job_memory'],
-                  job_options=self.PARAMS.get('bmtagger_job_options',''))
+
+        # stage the decompressed inputs first; the per-file statements
+        # are independent of one another
+        P.run(self.stage_statements,
+              job_threads=self.PARAMS.get('pigz_threads', 4),
+              job_memory=self.PARAMS['bmtagger_job_memory'],
+              job_options=self.PARAMS.get('bmtagger_job_options',''))
+
+        # screens against different host genomes are independent, so
+        # hand the whole list to P.run in one call and let cgatcore
+        # dispatch them concurrently
+        P.run(statements,
+              job_threads=self.PARAMS['bmtagger_job_threads'],
+              job_memory=self.PARAMS['bmtagger_job_memory'],
+              job_options=self.PARAMS.get('bmtagger_job_options',''))
+
+        for tmpf in self.staged_tmpfiles:
+            os.unlink(tmpf)
+
+        # union the per-index hit lists; appending to the shared
+        # to_remove files from within the concurrent statements would
+        # interleave partial writes
+        for hit_file, to_remove in self.host_hits:
+            with open(to_remove, 'ab') as outf, open(hit_file, 'rb') as inf:
+                shutil.copyfileobj(inf, outf)
+            os.unlink(hit_file)
         
     def postProcess(self, to_remove_tmp):
 
@@ -622,16 +921,21 @@ class bmtagger(matchReference):
             
             fastq1 = self.fastq1
             fastq2 = self.fastq2
-            
-            fastq1_out = self.outfile
-            fastq2_out = P.snip(self.outfile, self.fq1_suffix) + self.fq2_suffix
-            
-            fastq1_host = P.snip(self.outfile, '_dehost'+self.fq1_suffix) + '_host'+self.fq1_suffix
-            fastq2_host = P.snip(self.outfile, '_dehost'+self.fq1_suffix) + '_host'+self.fq2_suffix
-            
             fastq3 = self.fastq3
-            fastq3_out = P.snip(self.outfile, self.fq1_suffix) + self.fq3_suffix
-            fastq3_host = P.snip(self.outfile, '_dehost'+self.fq1_suffix) + '_host'+self.fq3_suffix
+
+            # all output paths hang off two stems; compute them once
+            out_stub = P.snip(self.outfile, self.fq1_suffix)
+            host_stub = (P.snip(self.outfile, '_dehost' + self.fq1_suffix)
+                         + '_host')
+
+            fastq1_out = self.outfile
+            fastq2_out = out_stub + self.fq2_suffix
+            fastq3_out = out_stub + self.fq3_suffix
+
+            fastq1_host = host_stub + self.fq1_suffix
+            fastq2_host = host_stub + self.fq2_suffix
+            fastq3_host = host_stub + self.fq3_suffix
+
             to_remove_paired = to_remove_tmp[0]
             to_remove_singletons = to_remove_tmp[1]
 
@@ -659,7 +963,8 @@ class bmtagger(matchReference):
             fastq1 = self.fastq1
             outfile = self.outfile
             to_remove = to_remove_tmp[0]
-            fastq_host = P.snip(self.outfile, '_dehost'+self.fq1_suffix) + '_host'+self.fq1_suffix
+            fastq_host = (P.snip(self.outfile, '_dehost' + self.fq1_suffix)
+                          + '_host' + self.fq1_suffix)
             statement = ("ocms_shotgun drop_fastqs"
                          " --fastq1 %(fastq1)s"
                          " --to-drop-single %(to_remove)s"
@@ -672,6 +977,173 @@ class bmtagger(matchReference):
             os.unlink(to_remove)
 
         
+class hisat2(matchReference):
+    """
+    Remove host reads by aligning against a host genome with HISAT2.
+
+    HISAT2 output is piped straight through samtools view/fastq, so
+    neither a SAM nor a BAM file is ever written to disk; only the
+    unmapped (non-host) reads are materialised, already compressed.
+    """
+
+    def buildStatement(self):
+        fastq1 = self.fastq1
+        fastq2 = self.fastq2
+        fastq3 = self.fastq3
+
+        outfile1 = self.outfile
+        sample_out = P.snip(self.outfile, self.fq1_suffix)
+        outfile2 = sample_out + self.fq2_suffix
+        outfile3 = sample_out + self.fq3_suffix
+        logfile = sample_out + '.log'
+        summary_file = sample_out + '.hisat2_summary.txt'
+
+        hisat2_index = self.PARAMS['hisat2_index']
+        hisat2_options = self.PARAMS.get('hisat2_options', '')
+        job_threads = self.PARAMS['hisat2_job_threads']
+
+        if self.fastq2:
+            # keep only pairs where neither mate aligns to the host
+            # (-f 12: read unmapped and mate unmapped)
+            statement = ("hisat2"
+                         "  -x %(hisat2_index)s"
+                         "  -1 %(fastq1)s"
+                         "  -2 %(fastq2)s"
+                         "  --threads %(job_threads)s"
+                         "  --new-summary"
+                         "  --summary-file %(summary_file)s"
+                         "  %(hisat2_options)s"
+                         "  2> %(logfile)s |"
+                         " samtools view -b -f 12 - |"
+                         " samtools fastq"
+                         "  -1 %(outfile1)s"
+                         "  -2 %(outfile2)s"
+                         "  -0 /dev/null -s /dev/null"
+                         "  -" % locals())
+
+            if self.fastq3 and not utility.gzip_empty(self.fastq3):
+                statement2 = ("hisat2"
+                              "  -x %(hisat2_index)s"
+                              "  -U %(fastq3)s"
+                              "  --threads %(job_threads)s"
+                              "  %(hisat2_options)s"
+                              "  2>> %(logfile)s |"
+                              " samtools view -b -f 4 - |"
+                              " samtools fastq - 2>> %(logfile)s |"
+                              " gzip > %(outfile3)s" % locals())
+            else:
+                # keep the file layout consistent with the paired output
+                statement2 = ("echo -n | gzip > %(outfile3)s" % locals())
+
+            statement = " && ".join([statement, statement2])
+
+        else:
+            statement = ("hisat2"
+                         "  -x %(hisat2_index)s"
+                         "  -U %(fastq1)s"
+                         "  --threads %(job_threads)s"
+                         "  --new-summary"
+                         "  --summary-file %(summary_file)s"
+                         "  %(hisat2_options)s"
+                         "  2> %(logfile)s |"
+                         " samtools view -b -f 4 - |"
+                         " samtools fastq - 2>> %(logfile)s |"
+                         " gzip > %(outfile1)s" % locals())
+
+        return statement
+
+    def run(self):
+
+        statement = self.buildStatement()
+
+        P.run(statement,
+              job_threads=self.PARAMS['hisat2_job_threads'],
+              job_memory=self.PARAMS['hisat2_job_memory'],
+              job_options=self.PARAMS.get('hisat2_job_options', ''))
+
+
+class minimap2(matchReference):
+    """
+    Remove host reads by aligning against a host reference with
+    minimap2 in short-read mode, piped through samtools like the
+    hisat2 wrapper.
+
+    Hardware-accelerated minimap2 builds (e.g. mm2-fast) can be
+    substituted via minimap2_executable, with any accelerator
+    resources requested through minimap2_job_options.
+    """
+
+    def buildStatement(self):
+        fastq1 = self.fastq1
+        fastq2 = self.fastq2
+        fastq3 = self.fastq3
+
+        outfile1 = self.outfile
+        sample_out = P.snip(self.outfile, self.fq1_suffix)
+        outfile2 = sample_out + self.fq2_suffix
+        outfile3 = sample_out + self.fq3_suffix
+        logfile = sample_out + '.log'
+
+        executable = self.PARAMS.get('minimap2_executable', 'minimap2')
+        minimap2_index = self.PARAMS['minimap2_index']
+        minimap2_options = self.PARAMS.get('minimap2_options', '')
+        job_threads = self.PARAMS['minimap2_job_threads']
+
+        if self.fastq2:
+            statement = ("%(executable)s"
+                         "  -ax sr"
+                         "  -t %(job_threads)s"
+                         "  %(minimap2_options)s"
+                         "  %(minimap2_index)s"
+                         "  %(fastq1)s %(fastq2)s"
+                         "  2> %(logfile)s |"
+                         " samtools view -b -f 12 - |"
+                         " samtools fastq"
+                         "  -1 %(outfile1)s"
+                         "  -2 %(outfile2)s"
+                         "  -0 /dev/null -s /dev/null"
+                         "  -" % locals())
+
+            if self.fastq3 and not utility.gzip_empty(self.fastq3):
+                statement2 = ("%(executable)s"
+                              "  -ax sr"
+                              "  -t %(job_threads)s"
+                              "  %(minimap2_options)s"
+                              "  %(minimap2_index)s"
+                              "  %(fastq3)s"
+                              "  2>> %(logfile)s |"
+                              " samtools view -b -f 4 - |"
+                              " samtools fastq - 2>> %(logfile)s |"
+                              " gzip > %(outfile3)s" % locals())
+            else:
+                statement2 = ("echo -n | gzip > %(outfile3)s" % locals())
+
+            statement = " && ".join([statement, statement2])
+
+        else:
+            statement = ("%(executable)s"
+                         "  -ax sr"
+                         "  -t %(job_threads)s"
+                         "  %(minimap2_options)s"
+                         "  %(minimap2_index)s"
+                         "  %(fastq1)s"
+                         "  2> %(logfile)s |"
+                         " samtools view -b -f 4 - |"
+                         " samtools fastq - 2>> %(logfile)s |"
+                         " gzip > %(outfile1)s" % locals())
+
+        return statement
+
+    def run(self):
+
+        statement = self.buildStatement()
+
+        P.run(statement,
+              job_threads=self.PARAMS['minimap2_job_threads'],
+              job_memory=self.PARAMS['minimap2_job_memory'],
+              job_options=self.PARAMS.get('minimap2_job_options', ''))
+
+
 class bbtools(matchReference):
 
     def buildStatement(self):
@@ -689,10 +1161,19 @@ class bbtools(matchReference):
         # I can't find any instructions as to how to override this.
         entropy = self.PARAMS['dust_entropy']
         bb_options= ' '.join(self.PARAMS['dust_options'].split(','))
+        # have bbtools shell out to pigz for its gzip streams rather
+        # than compressing single-threaded inside the JVM; the output
+        # is transient, so favour a fast compression level
+        bb_options += (' pigz=t unpigz=t zl=%s'
+                       % self.PARAMS.get('dust_gzip_level', 2))
         job_threads = self.PARAMS.get("dust_job_threads")
 
+        # derive every path variant from two stems computed once,
+        # rather than re-snipping the outfile for each one
         sample_out = P.snip(self.outfile, self.fq1_suffix)
-        
+        disc_stub = (P.snip(self.outfile, '_masked' + self.fq1_suffix)
+                     + '_discarded.fastq')
+
         fastq1 = self.fastq1
         fastq2 = self.fastq2
         fastq3 = self.fastq3
@@ -701,12 +1182,9 @@ class bbtools(matchReference):
         outfile1 = sample_out + '.1.fq.gz'
         outfile2 = sample_out + '.2.fq.gz'
         outfile3 = sample_out + '.3.fq.gz'
-        out_disc1 = P.snip(self.outfile, '_masked' + self.fq1_suffix) \
-            + '_discarded.fastq.1.fq.gz'
-        out_disc2 = P.snip(self.outfile, '_masked' + self.fq1_suffix) \
-            + '_discarded.fastq.2.fq.gz'
-        out_disc3 = P.snip(self.outfile, '_masked' + self.fq1_suffix) \
-            + '_discarded.fastq.3.fq.gz'
+        out_disc1 = disc_stub + '.1.fq.gz'
+        out_disc2 = disc_stub + '.2.fq.gz'
+        out_disc3 = disc_stub + '.3.fq.gz'
         
         if self.fastq2:
             if self.PARAMS['dust_discard_low_complexity']:
@@ -721,7 +1199,7 @@ class bbtools(matchReference):
                               "  threads=%(job_threads)s"
                               "  %(bb_options)s"
                               "  &> %(outfile)s.log" % locals())
-                if IOTools.open_file(fastq3).read(1):
+                if not utility.gzip_empty(fastq3):
                     statement2 = (" bbduk.sh"
                                   "  in=%(fastq3)s"
                                   "  out=%(outfile3)s"
@@ -736,25 +1214,20 @@ class bbtools(matchReference):
                 statement = " && ".join([statement1, statement2])
 
             else:
+                # one invocation for both mates: a single JVM startup
+                # and one thread pool shared across the pair
                 statement1 = ("bbmask.sh"
                               "  in=%(fastq1)s"
+                              "  in2=%(fastq2)s"
                               "  out=%(outfile1)s"
+                              "  out2=%(outfile2)s"
                               "  entropy=%(entropy)s"
                               "  threads=%(job_threads)s"
                               "  overwrite=t"
                               "  lowercase=t"
                               "  %(bb_options)s"
-                              "  &> %(outfile)s.log &&"
-                              " bbmask.sh"
-                              "  in=%(fastq2)s"
-                              "  out=%(outfile2)s"
-                              "  entropy=%(entropy)s"
-                              "  threads=%(job_threads)s"
-                              "  overwrite=t"
-                              "  lowercase=t"
-                              "  %(bb_options)s"
-                              "  &>> %(outfile)s.log" % locals())
-                if IOTools.open_file(fastq3).read(1):           
+                              "  &> %(outfile)s.log" % locals())
+                if not utility.gzip_empty(fastq3):           
                     statement2 = (" bbmask.sh"
                                   "  in=%(fastq3)s"
                                   "  out=%(outfile3)s"
@@ -774,7 +1247,7 @@ class bbtools(matchReference):
                 statement = ("bbduk.sh"
                              " in=%(fastq1)s"
                              " out=%(outfile1)s"
-                             " outm=%(out_disc)s"
+                             " outm=%(out_disc1)s"
                              " entropy=%(entropy)s"
                              " threads=%(job_threads)s"
                              " lowercase=t"
@@ -803,79 +1276,89 @@ class bbtools(matchReference):
               job_options=self.PARAMS.get('dust_job_options', ''))
     
     def postProcess(self):
+        # Renaming files because of bbmap idiosyncracies; the .N.fq.gz
+        # names bbmap wrote and the .fastq.N.gz names the pipeline
+        # expects both hang off the same stems
         sample_out = P.snip(self.outfile, self.fq1_suffix)
-        fastq1 = self.fastq1
-        fastq2 = self.fastq2
-        fastq3 = sample_out + self.fq3_suffix
+        disc_stub = (P.snip(self.outfile, '_masked' + self.fq1_suffix)
+                     + '_discarded.fastq')
         outfile = self.outfile
-        outfile1 = sample_out + '.1.fq.gz'
-        outfile2 = sample_out + '.2.fq.gz'
-        outfile3 = sample_out + '.3.fq.gz'
-        out_disc1 = P.snip(self.outfile, '_masked' + self.fq1_suffix) \
-            + '_discarded.fastq.1.fq.gz'
-        out_disc2 = P.snip(self.outfile, '_masked' + self.fq1_suffix) \
-            + '_discarded.fastq.2.fq.gz'
-        out_disc3 = P.snip(self.outfile, '_masked' + self.fq1_suffix) \
-            + '_discarded.fastq.3.fq.gz'
+
         if self.fastq2:
-            # Renaming files because of bbmap idiosyncracies
-            of1 = P.snip(outfile1, '.1.fq.gz') + self.fq1_suffix
-            of2 = P.snip(outfile2, '.2.fq.gz') + self.fq2_suffix
-            of3 = P.snip(outfile3, '.3.fq.gz') + self.fq3_suffix
-            os.rename(outfile1, of1)
-            os.rename(outfile2, of2)
-            os.rename(outfile3, of3)
+            os.rename(sample_out + '.1.fq.gz', sample_out + self.fq1_suffix)
+            os.rename(sample_out + '.2.fq.gz', sample_out + self.fq2_suffix)
+            os.rename(sample_out + '.3.fq.gz', sample_out + self.fq3_suffix)
 
             if self.PARAMS['dust_discard_low_complexity']:
-                od1 = P.snip(out_disc1, '.1.fq.gz') + self.fq1_suffix
-                od2 = P.snip(out_disc2, '.2.fq.gz') + self.fq2_suffix
-                od3 = P.snip(out_disc3, '.3.fq.gz') + self.fq3_suffix
-                os.rename(out_disc1, od1)
-                os.rename(out_disc2, od2)
-                os.rename(out_disc3, od3)
+                os.rename(disc_stub + '.1.fq.gz',
+                          disc_stub + self.fq1_suffix)
+                os.rename(disc_stub + '.2.fq.gz',
+                          disc_stub + self.fq2_suffix)
+                os.rename(disc_stub + '.3.fq.gz',
+                          disc_stub + self.fq3_suffix)
 
         else:
-            os.rename(outfile1, outfile)
+            os.rename(sample_out + '.1.fq.gz', outfile)
             if self.PARAMS['dust_discard_low_complexity']:
-                od1 = P.snip(out_disc1, '.1.fq.gz') + self.fq1_suffix
-            os.rename(out_disc, od1)
+                os.rename(disc_stub + '.1.fq.gz',
+                          disc_stub + self.fq1_suffix)
+
+
+def mergeHisatSummary(logfiles, outfile):
+    '''Combine per-sample hisat2 --new-summary files into a single
+    table with one row per sample.'''
+
+    frames = []
+    for logfile in logfiles:
+        sample_id = P.snip(os.path.basename(logfile),
+                           '_dehost.hisat2_summary.txt')
+        df = pd.read_csv(logfile, sep=':', engine='c', skiprows=1,
+                         header=None, names=['metric', 'value'])
+        df['metric'] = df['metric'].str.strip()
+        # percentage metrics report e.g. "80 (80.00%)"; keep the count
+        df['value'] = df['value'].astype(str).str.split().str[0]
+        df['sample_id'] = sample_id
+        frames.append(df)
+
+    merged = pd.concat(frames).pivot(index='sample_id',
+                                     columns='metric',
+                                     values='value')
+    merged.to_csv(outfile, sep='\t')
 
 
 def summariseReadCounts(infiles, outfile):
-    with IOTools.open_file(outfile, 'w') as outf:
-        outf.write("sample_id\tinput_reads\toutput_reads\tduplicates\t"
-                   "adapter_contamination\trRNA\thost\tlow_complexity\t"
-                   "duplicates_percent\tadapters_percent\trrna_percent\t"
-                   "host_percent\tlow_complexity_perc\tremaining_percent\n")
-        for infile in infiles:
-            sample_id = P.snip(os.path.basename(infile),
-                               '_read_count_summary.tsv')
-            E.info('Processing sample %s' % sample_id)
-            
-            df = pd.read_table(infile, index_col=0, header=None)
-            deadapt = df.loc['deadapt', 1]
-            deduped = df.loc['deduped', 1]
-            rrna = df.loc['rRNAremoved', 1]
-            dehost = df.loc['dehost', 1]
-            masked = df.loc['masked', 1]
-            input_reads = df.loc['input', 1]
-            
-            lost_dup = input_reads - deduped
-            lost_adapt = deduped - deadapt
-            lost_rrna = deadapt - rrna
-            lost_host = rrna - dehost
-            lost_mask = dehost - masked
-
-            lost_dup_perc = round(lost_dup/float(input_reads) * 100, 2)
-            lost_adapt_perc = round(lost_adapt/float(input_reads) * 100, 2)
-            lost_rrna_perc = round(lost_rrna/float(input_reads) * 100, 2)
-            lost_host_perc = round(lost_host/float(input_reads) * 100, 2)
-            lost_mask_perc = round(lost_mask/float(input_reads) * 100, 2)
-            output_perc = round(masked/float(input_reads) * 100, 2)
-
-            outf.write('\t'.join(map(str, [sample_id, input_reads, masked, 
-                                           lost_dup, lost_adapt, lost_rrna, 
-                                           lost_host, lost_mask, lost_dup_perc, 
-                                           lost_adapt_perc, lost_rrna_perc, 
-                                           lost_host_perc, lost_mask_perc, 
-                                           output_perc])) + '\n')
+    '''Calculate the reads lost at each preprocessing step for all
+    samples with vectorised column arithmetic, rather than per-sample
+    scalar look-ups.'''
+
+    counts = {
+        P.snip(os.path.basename(infile), '_read_count_summary.tsv'):
+        pd.read_table(infile, index_col=0, header=None)[1]
+        for infile in infiles}
+
+    E.info('Summarising read counts for %i samples' % len(counts))
+
+    steps = ['input', 'deduped', 'deadapt', 'rRNAremoved', 'dehost', 'masked']
+    df = pd.DataFrame(counts).T.reindex(columns=steps)
+
+    # a step that produced no count is assumed to have lost no reads
+    df = df.ffill(axis=1)
+
+    lost = df.diff(axis=1).mul(-1).iloc[:, 1:].astype(int)
+    lost.columns = ['duplicates', 'adapter_contamination', 'rRNA',
+                    'host', 'low_complexity']
+
+    perc = lost.div(df['input'], axis=0).mul(100).round(2)
+    perc.columns = ['duplicates_percent', 'adapters_percent', 'rrna_percent',
+                    'host_percent', 'low_complexity_perc']
+
+    summary = pd.concat(
+        [df['input'].astype(int).rename('input_reads'),
+         df['masked'].astype(int).rename('output_reads'),
+         lost,
+         perc,
+         (df['masked'] / df['input'] * 100).round(2).rename(
+             'remaining_percent')],
+        axis=1)
+
+    summary.to_csv(outfile, sep='\t', index_label='sample_id')
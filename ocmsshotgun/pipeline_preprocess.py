@@ -53,6 +53,7 @@ from cgatcore import experiment as E
 import cgat.Fastq as Fastq
 
 import os,sys,re
+import shutil
 import sqlite3
 import itertools
 import distutils
@@ -64,16 +65,64 @@ import ocmsshotgun.modules.PreProcess as pp
 # set up params
 PARAMS = P.get_parameters(["pipeline.yml"])
 
+# Keys the statement builders interpolate unconditionally. A missing
+# key otherwise only raises when its task runs, which can be hours into
+# a run; check them all up front instead. Keys for optional routes
+# (sortmerna, hisat2, minimap2, fastp) are left to their own tasks.
+# Note bmtagger_keep_pairs is deliberately absent: it is read nowhere
+# (see the disabled block in PreProcess.bmtagger.buildStatement).
+REQUIRED_PARAMS = {
+    'data_type',
+    'cdhit_dedup', 'cdhit_options',
+    'cdhit_job_threads', 'cdhit_job_memory',
+    'trimmomatic_jar_path', 'trimmomatic_n_threads',
+    'trimmomatic_adapters', 'trimmomatic_seed_mismatches',
+    'trimmomatic_score_palendromic', 'trimmomatic_score_simple',
+    'trimmomatic_min_adapter_len', 'trimmomatic_keep_both_reads',
+    'trimmomatic_quality_leading', 'trimmomatic_quality_trailing',
+    'trimmomatic_minlen',
+    'trimmomatic_job_threads', 'trimmomatic_job_memory',
+    'bmtagger_bitmask', 'bmtagger_srprism',
+    'bmtagger_job_threads', 'bmtagger_job_memory',
+    'dust_discard_low_complexity', 'dust_entropy', 'dust_options',
+    'dust_job_threads', 'dust_job_memory',
+    'count_job_threads',
+}
+
+missing = REQUIRED_PARAMS - set(PARAMS)
+assert not missing, \
+    'Missing required pipeline.yml keys: %s' % ', '.join(sorted(missing))
+
 # check that input files correspond
-FASTQ1S = pp.utility.check_input()
+FASTQ1S = pp.utility.cached_check_input()
+
+# if enabled, a single fastp pass replaces the separate cd-hit-dup and
+# trimmomatic stages
+USE_FASTP = PARAMS.get('fastp_enabled', False)
+
+# cap on per-sample jobs in flight at once; I/O-heavy and CPU-heavy
+# stages are limited separately so that deduplication and host removal
+# don't saturate shared storage while the CPU-bound stages still fill
+# the available slots
+MAX_PARALLEL_SAMPLES = PARAMS.get('max_parallel_samples', 8)
 
 ###############################################################################
 # Deduplicate
 ###############################################################################
+# Precompute the input -> output manifest once with str.replace; this
+# avoids ruffus regex-matching every input path at decorator evaluation,
+# which is slow for large input directories.
+DEDUP_MANIFEST = [
+    (fastq1, os.path.join(
+        'reads_deduped.dir',
+        os.path.basename(fastq1).replace('.fastq.1.gz',
+                                         '_deduped.fastq.1.gz')))
+    for fastq1 in FASTQ1S]
+
+@active_if(not USE_FASTP)
+@jobs_limit(MAX_PARALLEL_SAMPLES, 'io_heavy')
 @follows(mkdir('reads_deduped.dir'))
-@transform(FASTQ1S,
-           regex(r'.+/(.+).fastq.1.gz'),
-           r"reads_deduped.dir/\1_deduped.fastq.1.gz")
+@files(DEDUP_MANIFEST)
 def removeDuplicates(fastq1, outfile):
     '''Filter exact duplicates, if specified in config file'''
     pp.cdhit(fastq1, outfile, **PARAMS).run()
@@ -81,6 +130,8 @@ def removeDuplicates(fastq1, outfile):
 ###############################################################################
 # Remove Adapters
 ###############################################################################
+@active_if(not USE_FASTP)
+@jobs_limit(MAX_PARALLEL_SAMPLES, 'cpu_heavy')
 @follows(mkdir('reads_adaptersRemoved.dir'))
 @transform(removeDuplicates,
            regex(r'.+/(.+)_deduped.fastq.1.gz'),
@@ -91,11 +142,23 @@ def removeAdapters(fastq1, outfile1):
     pp.trimmomatic(fastq1, outfile1, **PARAMS).run()
 
 
+@active_if(USE_FASTP)
+@jobs_limit(MAX_PARALLEL_SAMPLES, 'cpu_heavy')
+@follows(mkdir('reads_adaptersRemoved.dir'))
+@transform(FASTQ1S,
+           regex(r'.+/(.+).fastq.1.gz'),
+           r'reads_adaptersRemoved.dir/\1_deadapt.fastq.1.gz')
+def runFastp(fastq1, outfile1):
+    '''Fused dedup, adapter and quality trimming with fastp'''
+
+    pp.fastp(fastq1, outfile1, **PARAMS).run()
+
+
 ###############################################################################
 # Remove Contamination
 ###############################################################################
 @follows(mkdir('reads_rrnaRemoved.dir'))
-@transform(removeAdapters,
+@transform([removeAdapters, runFastp],
            regex(r'.+/(.+)_deadapt.fastq.1.gz'),
            r'reads_rrnaRemoved.dir/\1_rRNAremoved.fastq.1.gz')
 def removeRibosomalRNA(fastq1, outfile):
@@ -118,15 +181,19 @@ def removeRibosomalRNA(fastq1, outfile):
         outf2 = P.snip(outf1, '.fastq.1.gz') + '.fastq.2.gz'
         outf3 = P.snip(outf1, '.fastq.1.gz') + '.fastq.3.gz'
         
+        # one directory scan instead of two stat calls per sample;
+        # stat latency adds up on networked filesystems
+        present = {x.name for x in os.scandir(os.path.dirname(inf1))}
+
         pp.utility.symlnk(inf1, outf1)
-        if os.path.exists(inf2):
+        if os.path.basename(inf2) in present:
             pp.utility.symlnk(inf2, outf2)
-        if os.path.exists(inf3):
+        if os.path.basename(inf3) in present:
             pp.utility.symlnk(inf3, outf3)
 
 
 @follows(mkdir('reads_rrnaClassified.dir'))
-@transform(removeAdapters,
+@transform([removeAdapters, runFastp],
            regex(r'.+/(.+)_deadapt.fastq.1.gz'),
            r'reads_rrnaClassified.dir/\1_otu_map.txt')
 def classifyRibosomalRNA(fastq1, outfile):
@@ -145,13 +212,15 @@ def summarizeRibosomalRNAClassification(infile, outfile):
     '''Count the number of reads mapping to each taxon'''
     
     sample_id = P.snip(infile, '_otu_map.txt', strip_path=True)
-    
-    with IOTools.open_file(outfile, 'w') as outf:
-        outf.write('taxonomy\t%s\n' % sample_id)
-        for otu in IOTools.open_file(infile):
-            taxonomy = otu.split()[0]
-            reads = otu.split()[1:]
-            outf.write(taxonomy + '\t' + str(len(reads)) + '\n')
+
+    # one awk pass in place of a per-line python loop; the read count
+    # for each taxon is just the number of fields after the first
+    statement = ("awk 'BEGIN {print \"taxonomy\\t%(sample_id)s\"}"
+                 " {print $1\"\\t\"NF-1}'"
+                 " %(infile)s |"
+                 " gzip > %(outfile)s")
+
+    P.run(statement, to_cluster=False)
 
 
 @merge(summarizeRibosomalRNAClassification,
@@ -159,31 +228,58 @@ def summarizeRibosomalRNAClassification(infile, outfile):
 def combineRNAClassification(infiles, outfile):
     '''Combine output of sortmerna read classification'''
 
-    infiles = ' '.join(infiles)
+    df = None
+    for infile in sorted(infiles):
+        df_sample = pd.read_csv(infile, sep='\t')
+        if df is None:
+            df = df_sample
+        else:
+            df = pd.merge(df, df_sample, on='taxonomy', how='outer')
 
-    statement = ("cgat combine_tables"
-                 "  --log=%(outfile)s.log"
-                 "  %(infiles)s |"
-                 " gzip > %(outfile)s")
-    P.run(statement, to_cluster=False)
+    sample_cols = [x for x in df.columns if x != 'taxonomy']
+    df[sample_cols] = df[sample_cols].fillna(0).astype(int)
+    df.to_csv(outfile, sep='\t', index=False)
 
+@jobs_limit(MAX_PARALLEL_SAMPLES, 'io_heavy')
 @follows(mkdir('reads_hostRemoved.dir'))
 @transform(removeRibosomalRNA,
            regex('.+/(.+)_rRNAremoved.fastq.1.gz'),
            r'reads_hostRemoved.dir/\1_dehost.fastq.1.gz')
 def removeHost(fastq1, outfile):
-    '''Remove host contamination using bmtagger'''
+    '''Remove host contamination using bmtagger, hisat2 or minimap2'''
+
+    host_tool = PARAMS.get('host_tool', 'bmtagger')
+
+    if host_tool == 'hisat2':
+        tool = pp.hisat2(fastq1, outfile, **PARAMS)
+        tool.run()
+    elif host_tool == 'minimap2':
+        tool = pp.minimap2(fastq1, outfile, **PARAMS)
+        tool.run()
+    else:
+        assert host_tool == 'bmtagger', \
+            'Unrecognised host removal tool: {}'.format(host_tool)
+        tool = pp.bmtagger(fastq1, outfile, **PARAMS)
+        statements, tmpfiles = tool.buildStatement()
+
+        tool.run(statements)
+        tool.postProcess(tmpfiles)
+
 
-    tool = pp.bmtagger(fastq1, outfile, **PARAMS)
-    statements, tmpfiles = tool.buildStatement()
+@active_if(PARAMS.get('host_tool', 'bmtagger') == 'hisat2')
+@merge(removeHost, 'reads_hostRemoved.dir/hisat2_summary.tsv')
+def mergeHisatSummary(infiles, outfile):
+    '''Combine the hisat2 alignment summaries across samples'''
 
-    tool.run(statements)
-    tool.postProcess(tmpfiles)
+    logfiles = [P.snip(x, '.fastq.1.gz') + '.hisat2_summary.txt'
+                for x in infiles]
+    pp.mergeHisatSummary(logfiles, outfile)
 
 
 ###############################################################################
 # Mask or Remove Low-complexity sequence
 ###############################################################################
+@jobs_limit(MAX_PARALLEL_SAMPLES, 'cpu_heavy')
 @follows(mkdir('reads_dusted.dir'))
 @transform(removeHost,
            regex(r'.+/(.+)_dehost.fastq.1.gz'),
@@ -210,30 +306,42 @@ def maskLowComplexity(fastq1, outfile):
 # def plotDeadaptLengthDistribution(infile, outfile):
 #     '''Create a histogram of length distributions'''
 @follows(mkdir('read_count_summary.dir'))
-@transform(FASTQ1S,
-           regex(r'.+/(.+).fastq.1.gz'),
-           r"read_count_summary.dir/\1_input.nreads")
-def countInputReads(infile, outfile):
-    
-    statement = ("zcat %(infile)s |"
-                 " awk '{n+=1;} END {printf(n/4\"\\n\");}'"
-                 " > %(outfile)s")
+@split(FASTQ1S, 'read_count_summary.dir/*_input.nreads')
+def countInputReads(infiles, outfiles):
+    '''Count the number of reads in the input files. All samples are
+    counted in one batched submission, rather than one scheduler
+    round-trip per sample.'''
 
-    P.run(statement)
+    statements = []
+    for infile in infiles:
+        outfile = os.path.join(
+            'read_count_summary.dir',
+            P.snip(os.path.basename(infile), '.fastq.1.gz') + '_input.nreads')
+        statements.append("pigz -dc -p %(count_job_threads)s " + infile + " |"
+                          " LC_ALL=C wc -l |"
+                          " awk '{print int($1/4)}' > " + outfile)
+
+    P.run(statements, job_threads=PARAMS['count_job_threads'])
 
 
 @follows(countInputReads)
-@transform([removeDuplicates, removeAdapters, removeRibosomalRNA,
+@transform([removeDuplicates, removeAdapters, runFastp, removeRibosomalRNA,
             removeHost, maskLowComplexity],
            regex(r'.+/(.+).fastq.1.gz'),
            r'read_count_summary.dir/\1.nreads')
 def countOutputReads(infile, outfile):
-    '''Count the number of reads in the output files'''    
-    statement = ("zcat %(infile)s |"
-                 " awk '{n+=1;} END {printf(n/4\"\\n\");}'"
-                 " > %(outfile)s")
-
-    P.run(statement)
+    '''Count the number of reads in the output files. Tasks that can
+    count reads as a side-effect of writing their output leave a
+    .nreads file next to the FASTQ; re-use it rather than decompressing
+    the FASTQ a second time.'''
+
+    nreads_file = infile + '.nreads'
+    if os.path.exists(nreads_file):
+        shutil.copyfile(nreads_file, outfile)
+    else:
+        nreads = pp.utility.count_fastq_reads(infile)
+        with open(outfile, 'w') as outf:
+            outf.write('%i\n' % nreads)
 
 @collate([countInputReads, countOutputReads],
          regex(r'(.+)_(input|deduped|deadapt|dehost|rRNAremoved|masked).nreads'),
@@ -241,23 +349,21 @@ def countOutputReads(infile, outfile):
 def collateReadCounts(infiles, outfile):
     '''Collate read counts for each sample'''
 
-    infiles = ' '.join(infiles)
-    
-    statement = ("cgat combine_tables"
-                 " --cat Step"
-                 " --regex-filename='.+_(.+)\.nreads'"
-                 " --no-titles"
-                 " --log=%(outfile)s.log"
-                 " %(infiles)s"
-                 " > %(outfile)s")
-    P.run(statement)
+    step_regex = re.compile(r'.+_(.+)\.nreads')
+
+    with IOTools.open_file(outfile, 'w') as outf:
+        for infile in sorted(infiles):
+            step = step_regex.match(os.path.basename(infile)).group(1)
+            with IOTools.open_file(infile) as inf:
+                nreads = inf.read().strip()
+            outf.write(step + '\t' + nreads + '\n')
     
 @merge(collateReadCounts, 'processing_summary.tsv')
 def summarizeReadCounts(infiles, outfile):
     '''Calculate the number of reads lost at each step for each sample'''
     pp.summariseReadCounts(infiles, outfile)
 
-@follows(summarizeReadCounts)
+@follows(summarizeReadCounts, mergeHisatSummary)
 def full():
     pass
 
@@ -18,14 +18,21 @@ Will iterate over the fastqs and drop any entries in the respective file.
 
 
 import cgatcore.experiment as E
-import cgatcore.iotools as IOTools
-import cgat.Fastq as Fastq
+
+from ocmsshotgun.modules.PreProcess import utility
 
 import pandas as pd
 
 import os,re,sys
 
 
+def fastq_records(handle):
+    """Iterate over raw 4-line fastq records without parsing them.
+    Records pass straight from input to output, so there is no need to
+    build Fastq objects and re-format them read by read."""
+    return zip(handle, handle, handle, handle)
+
+
 def main(argv=None):
 
     if argv is None:
@@ -54,84 +61,60 @@ def main(argv=None):
     (options, args) = E.start(parser)
 
     # Fetch the reads to remove
-    pairs_to_remove = IOTools.open_file(options.to_remove_paired).readlines()
-    pairs_to_remove = set([x.strip() for x in pairs_to_remove])
+    with utility.open_file(options.to_remove_paired) as inf:
+        pairs_to_remove = set(x.strip() for x in inf)
 
-    print(pairs_to_remove)
-    
-    singles_to_remove = IOTools.open_file(options.to_remove_singletons).readlines()
-    singles_to_remove = set([x.strip() for x in singles_to_remove])
+    with utility.open_file(options.to_remove_singletons) as inf:
+        singles_to_remove = set(x.strip() for x in inf)
 
     # open the outfiles
-    fastq1_out = IOTools.open_file(options.fq_out1, 'w')
-    fastq2_out = IOTools.open_file(options.fq_out2, 'w')
-    fastq3_out = IOTools.open_file(options.fq_out3, 'w')
+    fastq1_out = utility.open_file(options.fq_out1, 'w')
+    fastq2_out = utility.open_file(options.fq_out2, 'w')
+    fastq3_out = utility.open_file(options.fq_out3, 'w')
 
-    fastq1_host = IOTools.open_file(options.fq_dropped1, 'w')
-    fastq2_host = IOTools.open_file(options.fq_dropped2, 'w')
-    fastq3_host = IOTools.open_file(options.fq_dropped3, 'w')
+    fastq1_host = utility.open_file(options.fq_dropped1, 'w')
+    fastq2_host = utility.open_file(options.fq_dropped2, 'w')
+    fastq3_host = utility.open_file(options.fq_dropped3, 'w')
 
     dropped_pairs = 0
     pairs = 0
     # Drop the paired reads
-    for read1, read2 in zip(Fastq.iterate(IOTools.open_file(options.fastq1)),
-                            Fastq.iterate(IOTools.open_file(options.fastq2))):
+    for read1, read2 in zip(fastq_records(utility.open_file(options.fastq1)),
+                            fastq_records(utility.open_file(options.fastq2))):
         pairs +=1
         
         # bmtagger truncates fastq headers at space and won't accept
         # non-identical headers therefore, if one read matches, both
         # are chucked.
-        r1_id = read1.identifier.split()[0]
-        r2_id = read2.identifier.split()[0]
-        
-        print(r1_id)
-        print(r2_id)
+        r1_id = read1[0].split()[0][1:]
+        r2_id = read2[0].split()[0][1:]
 
         if r1_id in pairs_to_remove or r2_id in pairs_to_remove:
             # Both are host
-            fastq1_host.write("@%s\n%s\n+\n%s\n" %
-                              (read1.identifier,
-                               read1.seq,
-                               read1.quals))
-            fastq2_host.write("@%s\n%s\n+\n%s\n" %
-                              (read2.identifier,
-                               read2.seq,
-                               read2.quals))
+            fastq1_host.write(''.join(read1))
+            fastq2_host.write(''.join(read2))
             dropped_pairs += 1
         else:
             # Neither are host
-            fastq1_out.write("@%s\n%s\n+\n%s\n" %
-                             (read1.identifier,
-                              read1.seq,
-                              read1.quals))
-            fastq2_out.write("@%s\n%s\n+\n%s\n" %
-                             (read2.identifier,
-                              read2.seq,
-                              read2.quals))
+            fastq1_out.write(''.join(read1))
+            fastq2_out.write(''.join(read2))
     # Drop singletons
     singletons = 0
     dropped_singletons = 0
-    if IOTools.open_file(options.fastq3).read(1):
-        for read in Fastq.iterate(IOTools.open_file(options.fastq3)):
-            singletons += 1
-            if read.identifier.split()[0] in singles_to_remove:
-                fastq3_host.write("@%s\n%s\n+\n%s\n" %
-                                  (read.identifier,
-                                   read.seq,
-                                   read.quals))
-                dropped_singletons +=1
-            else:
-                fastq3_out.write("@%s\n%s\n+\n%s\n" %
-                                 (read.identifier,
-                                  read.seq,
-                                  read.quals))
-
-        fastq1_out.close()
-        fastq2_out.close()
-        fastq3_out.close()
-        fastq1_host.close()
-        fastq2_host.close()
-        fastq3_host.close()
+    for read in fastq_records(utility.open_file(options.fastq3)):
+        singletons += 1
+        if read[0].split()[0][1:] in singles_to_remove:
+            fastq3_host.write(''.join(read))
+            dropped_singletons +=1
+        else:
+            fastq3_out.write(''.join(read))
+
+    fastq1_out.close()
+    fastq2_out.close()
+    fastq3_out.close()
+    fastq1_host.close()
+    fastq2_host.close()
+    fastq3_host.close()
 
     try:
         percent_pairs = dropped_pairs/float(pairs)*100